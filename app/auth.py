@@ -1,16 +1,35 @@
+import asyncio
+import binascii
+import hashlib
+import hmac
+import json
 import os
-from datetime import datetime, timedelta, timezone
-from typing import Any, cast
+import secrets
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from types import MappingProxyType
+from typing import Any, TypeVar, cast
 
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
-from sqlmodel import Session, select
+from jose import JWTError, jwk, jwt
+from jose.exceptions import ExpiredSignatureError, JWTClaimsError
+from jose.utils import base64url_decode, base64url_encode
+from sqlmodel import col, or_, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.database import get_session
+from app.deps import db_session, token_dependency
 from app.models import User
-from app.security import verify_password
+from app.security import (
+    BCRYPT_PREFIXES,
+    get_bcrypt_hash,
+    get_password_hash,
+    is_bcrypt_hash,
+    is_known_hash,
+    password_needs_rehash,
+    verify_password,
+)
 
 # Load environment variables
 load_dotenv()
@@ -23,56 +42,225 @@ if not _secret_key:
 SECRET_KEY: str = _secret_key
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+ACCESS_TOKEN_EXPIRE_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
 
-# OAuth2 scheme for token
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# Signing key and encoded JOSE header never change, so build them once instead of per token
+_SIGNING_KEY = jwk.construct(SECRET_KEY, ALGORITHM)
+_ENCODED_HEADER = base64url_encode(
+    json.dumps({"alg": ALGORITHM, "typ": "JWT"}, separators=(",", ":"), sort_keys=True).encode()
+)
 
-# Define dependencies at module level to avoid B008 ruff error
-token_dependency = Depends(oauth2_scheme)
-db_session = Depends(get_session)
+# Keyed HMAC-SHA256 state, copied for each HS256 token so the key is only prepared once
+_HMAC_PROTO = hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha256)
+
+# Decode our own HS256 tokens without jose; set FAST_JWT_DECODE=0 to always use jwt.decode
+USE_FAST_JWT_DECODE = os.getenv("FAST_JWT_DECODE", "1") == "1"
+
+# The only claims create_access_token issues, other claims are validated by jose
+_FAST_DECODE_CLAIMS = frozenset({"sub", "exp"})
+
+# Challenge header sent with every 401, read-only once built
+_BEARER_CHALLENGE = MappingProxyType({"WWW-Authenticate": "Bearer"})
+
+# Hashes verified against when the user doesn't exist, so unknown emails cost as much as bad
+# passwords. Their plaintexts are random and discarded, so no password ever matches them, and
+# they never get an entry in the verify cache.
+_DUMMY_HASH = get_password_hash(secrets.token_urlsafe(32))
+_DUMMY_BCRYPT_HASH = get_bcrypt_hash(secrets.token_urlsafe(32))
+
+# Whether any user still has a bcrypt hash, None until checked. Only a migration on login can
+# turn it false, so it is rechecked after each one.
+_bcrypt_hashes_remain: bool | None = None
+
+# LRU caches for clients that repeat the same token: SHA-256 of the token -> (subject, expiry),
+# and email -> user id so the user row can be loaded by primary key
+_CACHE_MAXSIZE = 8192
+_token_cache: OrderedDict[bytes, tuple[str, int]] = OrderedDict()
+_user_id_cache: OrderedDict[str, int] = OrderedDict()
+
+_K = TypeVar("_K")
+_V = TypeVar("_V")
+
+
+def _cache_put(cache: OrderedDict[_K, _V], key: _K, value: _V) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > _CACHE_MAXSIZE:
+        cache.popitem(last=False)
+
+
+# Decode and validate a token, handling the HS256 tokens we issue without jose's generic decoder
+def _decode_jwt(token: str) -> dict[str, Any]:
+    signing_input, _, encoded_signature = token.encode().rpartition(b".")
+    header_segment, dot, encoded_payload = signing_input.partition(b".")
+    # Token bytes are only ever compared in constant time
+    if (
+        not USE_FAST_JWT_DECODE
+        or ALGORITHM != "HS256"
+        or not dot
+        or not hmac.compare_digest(header_segment, _ENCODED_HEADER)
+    ):
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+    try:
+        signature = base64url_decode(encoded_signature)
+    except binascii.Error as e:
+        raise JWTError("Invalid signature encoding") from e
+    mac = _HMAC_PROTO.copy()
+    mac.update(signing_input)
+    if not hmac.compare_digest(mac.digest(), signature):
+        raise JWTError("Signature verification failed")
+
+    try:
+        claims = json.loads(base64url_decode(encoded_payload))
+    except (binascii.Error, ValueError) as e:
+        raise JWTError("Invalid payload") from e
+    if not isinstance(claims, dict):
+        raise JWTError("Invalid payload, must be a JSON object")
+    if not claims.keys() <= _FAST_DECODE_CLAIMS:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+    exp = claims.get("exp")
+    if exp is not None:
+        if not isinstance(exp, int):
+            raise JWTClaimsError("Expiration Time claim (exp) must be an integer.")
+        # Same rule as jose: the token is still valid during its exp second
+        if int(time.time()) > exp:
+            raise ExpiredSignatureError("Signature has expired.")
+    if not isinstance(claims.get("sub", ""), str):
+        raise JWTClaimsError("Subject must be a string.")
+    return claims
+
+
+# Decode a token to its subject, verifying the signature only on a cache miss
+def _decode_token(token: str) -> str | None:
+    token_sha = hashlib.sha256(token.encode()).digest()
+    cached = _token_cache.get(token_sha)
+    if cached is not None:
+        email, exp = cached
+        if exp > time.time():
+            _token_cache.move_to_end(token_sha)
+            return email
+        del _token_cache[token_sha]
+
+    payload = _decode_jwt(token)
+    sub_claim = payload.get("sub")
+    exp_claim = payload.get("exp")
+    if sub_claim is None:
+        return None
+    if isinstance(exp_claim, int):
+        _cache_put(_token_cache, token_sha, (cast(str, sub_claim), exp_claim))
+    return cast(str, sub_claim)
+
+
+# Look up a user by email, by primary key once the email's id is known
+async def _get_user_by_email(email: str, session: AsyncSession) -> User | None:
+    user_id = _user_id_cache.get(email)
+    if user_id is not None:
+        user = await session.get(User, user_id)
+        if user is not None and user.email == email:
+            _user_id_cache.move_to_end(email)
+            return user
+        del _user_id_cache[email]
+
+    statement = select(User).where(User.email == email)
+    user = (await session.exec(statement)).first()
+    if user is not None and user.id is not None:
+        _cache_put(_user_id_cache, email, user.id)
+    return user
+
+
+async def _any_bcrypt_hashes(session: AsyncSession) -> bool:
+    global _bcrypt_hashes_remain  # noqa: PLW0603
+    if _bcrypt_hashes_remain is None:
+        is_bcrypt = or_(*(col(User.password).startswith(prefix) for prefix in BCRYPT_PREFIXES))
+        statement = select(User.id).where(is_bcrypt).limit(1)
+        _bcrypt_hashes_remain = (await session.exec(statement)).first() is not None
+    return _bcrypt_hashes_remain
+
+
+def _verify_login(password: str, hashed_password: str, *, verify_both_schemes: bool) -> bool:
+    password_ok = verify_password(password, hashed_password)
+    # bcrypt hashes and argon2 hashes with other cost parameters don't cost what the argon2
+    # dummy does, so they are followed by a full-cost argon2 verify
+    if password_needs_rehash(hashed_password):
+        verify_password(password, _DUMMY_HASH)
+    if verify_both_schemes and not is_bcrypt_hash(hashed_password):
+        # Pay for bcrypt too, so bcrypt users, argon2 users and unknown emails all take one
+        # bcrypt verify on top
+        verify_password(password, _DUMMY_BCRYPT_HASH)
+    return password_ok
 
 
 # Authenticate user
-async def authenticate_user(email: str, password: str, session: Session) -> User | None:
+async def authenticate_user(email: str, password: str, session: AsyncSession) -> User | None:
+    global _bcrypt_hashes_remain  # noqa: PLW0603
     statement = select(User).where(User.email == email)
-    user = session.exec(statement).first()
-    if not user:
-        return None
-    if not verify_password(password, user.password):
+    user = (await session.exec(statement)).first()
+    # Always run the same password verifies to avoid a user-enumeration timing oracle. A stored
+    # value that is no usable hash, such as a plaintext password, is treated as a missing user.
+    stored_hash = user.password if user is not None and is_known_hash(user.password) else None
+    password_ok = await asyncio.to_thread(
+        _verify_login,
+        password,
+        stored_hash or _DUMMY_HASH,
+        verify_both_schemes=await _any_bcrypt_hashes(session),
+    )
+    if user is None or stored_hash is None or not password_ok:
         return None
+
+    # Move legacy bcrypt and outdated argon2 hashes to the current argon2id parameters
+    if password_needs_rehash(user.password):
+        migrated_bcrypt = is_bcrypt_hash(user.password)
+        user.password = await asyncio.to_thread(get_password_hash, password)
+        session.add(user)
+        await session.commit()
+        if migrated_bcrypt:
+            _bcrypt_hashes_remain = None
     return cast(User, user)
 
 
 # Create access token
 def create_access_token(data: dict[str, Any], expires_delta: timedelta | None = None) -> str:
     to_encode = data.copy()
+    # Plain epoch arithmetic, the exp claim is an integer timestamp anyway
     if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
+        expire_seconds = int(expires_delta.total_seconds())
     else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return cast(str, encoded_jwt)
+        expire_seconds = ACCESS_TOKEN_EXPIRE_SECONDS
+    to_encode["exp"] = int(time.time()) + expire_seconds
+    # Same encoding as jwt.encode, reusing the prebuilt header and key
+    encoded_payload = base64url_encode(json.dumps(to_encode, separators=(",", ":")).encode())
+    signing_input = _ENCODED_HEADER + b"." + encoded_payload
+    signature = base64url_encode(_SIGNING_KEY.sign(signing_input))
+    return (signing_input + b"." + signature).decode()
 
 
-# Get current user
-async def get_current_user(token: str = token_dependency, session: Session = db_session) -> User:
-    credentials_exception = HTTPException(
+# Built only when authentication fails; a shared instance would accumulate tracebacks
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
+        headers=_BEARER_CHALLENGE,
     )
+
+
+# Get current user
+async def get_current_user(
+    token: str = token_dependency, session: AsyncSession = db_session
+) -> User:
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        sub_claim = payload.get("sub")
-        if sub_claim is None:
-            raise credentials_exception
-        email: str = cast(str, sub_claim)
+        email = _decode_token(token)
     except JWTError as e:
-        raise credentials_exception from e
+        raise _credentials_exception() from e
+    if email is None:
+        raise _credentials_exception()
 
-    statement = select(User).where(User.email == email)
-    user = session.exec(statement).first()
+    user = await _get_user_by_email(email, session)
     if user is None:
-        raise credentials_exception
-    return cast(User, user)
+        raise _credentials_exception()
+    return user
+
+
+# Shared marker for routes that need the authenticated user
+current_user_dependency = Depends(get_current_user)
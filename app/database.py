@@ -1,8 +1,13 @@
 import os
-from collections.abc import Generator
+from collections.abc import AsyncIterator
 
 from dotenv import load_dotenv
-from sqlmodel import Session, SQLModel, create_engine, select
+from sqlalchemy import event, make_url, text
+from sqlalchemy.engine.interfaces import DBAPIConnection
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import ConnectionPoolEntry, StaticPool
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.models import Item, User
 from app.security import get_password_hash
@@ -12,33 +17,82 @@ load_dotenv()
 
 # Database URL from environment variable
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
-engine = create_engine(DATABASE_URL, echo=True, connect_args={"check_same_thread": False})
 
+# Plain SQLite URLs are served through the aiosqlite driver so queries don't block the event loop
+_database_url = make_url(DATABASE_URL)
+if _database_url.drivername == "sqlite":
+    _database_url = _database_url.set(drivername="sqlite+aiosqlite")
 
-# Create all tables
-def create_tables() -> None:
-    SQLModel.metadata.create_all(engine)
+# SQL statement logging is opt-in, it is too costly for the request path
+SQL_ECHO = os.getenv("SQL_ECHO") == "1"
 
+if DATABASE_URL.endswith(":memory:"):
+    # An in-memory database only lives as long as its connection, so share a single one
+    engine = create_async_engine(
+        _database_url,
+        echo=SQL_ECHO,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+else:
+    engine = create_async_engine(
+        _database_url,
+        echo=SQL_ECHO,
+        connect_args={"check_same_thread": False},
+        pool_pre_ping=True,
+        pool_size=20,
+        max_overflow=40,
+    )
 
-# Get session
-def get_session() -> Generator[Session, None, None]:
-    with Session(engine) as session:
+
+# Use write-ahead logging and fewer fsyncs on every new SQLite connection
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(
+    dbapi_connection: DBAPIConnection, connection_record: ConnectionPoolEntry
+) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+# Unique indexes the ON CONFLICT inserts rely on. create_all() skips tables that already
+# exist, so these are also created for databases made before the indexes were declared.
+_UNIQUE_INDEXES = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email ON user (email)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_item_name ON item (name)",
+)
+
+
+# Create all tables and their unique indexes
+async def create_tables() -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        for statement in _UNIQUE_INDEXES:
+            await conn.execute(text(statement))
+
+
+# Get session, keeping objects loaded after commit so routes can return them without a refresh
+async def get_session() -> AsyncIterator[AsyncSession]:
+    async with AsyncSession(engine, expire_on_commit=False) as session:
         yield session
 
 
 # Load test data
-def load_test_data() -> None:
-    with Session(engine) as session:
+async def load_test_data() -> None:
+    async with AsyncSession(engine) as session, session.begin():
         # Check if test data already exists
-        existing_users = session.exec(select(User)).all()
-        if existing_users:
+        existing_user = (await session.exec(select(User.id).limit(1))).first()
+        if existing_user is not None:
             print("Test data already exists, skipping...")
             return
 
         # Create test users
         test_users = [
             User(
-                name="John Doe", email="john@example.com", password=get_password_hash("password123")
+                name="John Doe",
+                email="john@example.com",
+                password=get_password_hash("password123"),
             ),
             User(
                 name="Jane Smith",
@@ -63,12 +117,7 @@ def load_test_data() -> None:
             ),
         ]
 
-        # Add test data to session
-        for user in test_users:
-            session.add(user)
-
-        for item in test_items:
-            session.add(item)
+        # Add all test data in a single transaction, committed when the block exits
+        session.add_all([*test_users, *test_items])
 
-        session.commit()
-        print("Test data loaded successfully!")
+    print("Test data loaded successfully!")
@@ -0,0 +1,36 @@
+"""Dependency markers shared by every router.
+
+Defined once at module level to avoid the B008 ruff error, and so each route reuses the
+same marker instead of building its own.
+"""
+
+from dataclasses import dataclass
+from typing import Annotated
+
+from fastapi import Depends, Form
+from fastapi.security import OAuth2PasswordBearer
+
+from app.database import get_session
+
+# OAuth2 scheme for token
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+
+# The only login fields /token reads, instead of the full OAuth2PasswordRequestForm
+@dataclass(slots=True)
+class LoginForm:
+    username: str
+    password: str
+
+
+async def login_form(
+    username: Annotated[str, Form()],
+    # Marked as a password so the docs UI masks it, like OAuth2PasswordRequestForm does
+    password: Annotated[str, Form(json_schema_extra={"format": "password"})],
+) -> LoginForm:
+    return LoginForm(username, password)
+
+
+token_dependency = Depends(oauth2_scheme)
+db_session = Depends(get_session)
+form_dependency = Depends(login_form)
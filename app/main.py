@@ -3,23 +3,31 @@ from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
-from app.database import create_tables, load_test_data
+from app.database import create_tables, engine, load_test_data
 from app.routes import auth, background_tasks, items, users
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncIterator[None]:
     # Startup
-    create_tables()
-    load_test_data()
-    yield
-    # Shutdown (if needed)
+    await create_tables()
+    await load_test_data()
+    audit_writer = background_tasks.start_audit_writer()
+    try:
+        yield
+    finally:
+        # Shutdown: stop the audit writer, which flushes pending entries, then close connections
+        try:
+            await background_tasks.stop_audit_writer(audit_writer)
+        finally:
+            await engine.dispose()
 
 
 app = FastAPI(title="FastAPI Article Demo", lifespan=lifespan)
+# Authentication routes go first so /users/me isn't shadowed by /users/{user_id}
+app.include_router(auth.router, tags=["Authentication"])
 app.include_router(users.router, prefix="/users", tags=["Users"])
 app.include_router(items.router, prefix="/items", tags=["Items"])
-app.include_router(auth.router, tags=["Authentication"])
 app.include_router(background_tasks.router, prefix="/tasks", tags=["Background Tasks"])
 
 
@@ -4,13 +4,13 @@ from sqlmodel import Field, SQLModel
 class User(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     name: str
-    email: str
+    email: str = Field(index=True, unique=True)
     password: str
 
 
 class Item(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    name: str
+    name: str = Field(index=True, unique=True)
     description: str | None = None
     price: float
     tax: float | None = None
@@ -1,11 +1,88 @@
+import asyncio
+import logging
+import os
+
 from fastapi import APIRouter, BackgroundTasks
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+AUDIT_LOG_PATH = "audit.log"
+
+# Maximum number of audit entries joined into a single write
+_AUDIT_BATCH_SIZE = 100
+
+# Pending audit entries, only set while a writer started by start_audit_writer() is running.
+# The queue is created inside the running event loop, since an asyncio.Queue binds to one loop.
+# None on the queue tells the writer to stop once everything before it is written.
+_log_queue: asyncio.Queue[bytes | None] | None = None
+
+
+def _append_entries(entries: list[bytes]) -> None:
+    fd = os.open(AUDIT_LOG_PATH, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, b"".join(entries))
+    finally:
+        os.close(fd)
+
+
+async def log_action(user: str) -> None:
+    entry = f"User {user} performed an action\n".encode()
+    if _log_queue is None:
+        # No writer running, so append the entry directly, off the event loop
+        await asyncio.to_thread(_append_entries, [entry])
+        return
+    _log_queue.put_nowait(entry)
+
+
+# Write queued audit entries in batches through one append-only file descriptor
+async def drain_audit_log(queue: asyncio.Queue[bytes | None]) -> None:
+    fd = os.open(AUDIT_LOG_PATH, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        stopping = False
+        while not stopping:
+            batch: list[bytes] = []
+            entry = await queue.get()
+            while entry is not None:
+                batch.append(entry)
+                if len(batch) >= _AUDIT_BATCH_SIZE or queue.empty():
+                    break
+                entry = queue.get_nowait()
+            stopping = entry is None
+            if batch:
+                # The write runs in a worker thread so disk I/O doesn't hold up other requests
+                await asyncio.to_thread(os.write, fd, b"".join(batch))
+    finally:
+        os.close(fd)
+
+
+# Start the audit writer on the running event loop and route log_action through it
+def start_audit_writer() -> asyncio.Task[None]:
+    global _log_queue  # noqa: PLW0603
+    queue: asyncio.Queue[bytes | None] = asyncio.Queue()
+    writer = asyncio.create_task(drain_audit_log(queue))
+    _log_queue = queue
+
+    def on_writer_done(task: asyncio.Task[None]) -> None:
+        global _log_queue  # noqa: PLW0603
+        # Stop queueing into a queue nobody drains, later entries are appended directly
+        if _log_queue is queue:
+            _log_queue = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Audit log writer failed", exc_info=task.exception())
+
+    writer.add_done_callback(on_writer_done)
+    return writer
+
 
-def log_action(user: str) -> None:
-    with open("audit.log", "a") as f:
-        f.write(f"User {user} performed an action\n")
+# Stop the audit writer after it has written every pending entry; failures are logged, not raised
+async def stop_audit_writer(writer: asyncio.Task[None]) -> None:
+    global _log_queue
+    queue, _log_queue = _log_queue, None
+    if queue is not None and not writer.done():
+        queue.put_nowait(None)
+    await asyncio.wait([writer])
 
 
 @router.post("/action/")
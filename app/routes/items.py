@@ -1,35 +1,35 @@
 from typing import cast
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
+from fastapi import APIRouter, HTTPException
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.database import get_session
+from app.deps import db_session
 from app.models import Item
 
 router = APIRouter()
 
-# Define dependencies at module level
-db_session = Depends(get_session)
-
 
 @router.post("/", response_model=Item)
-async def create_item(item: Item, session: Session = db_session) -> Item:
-    # Check if item with the same name already exists
-    statement = select(Item).where(Item.name == item.name)
-    existing_item = session.exec(statement).first()
-    if existing_item:
+async def create_item(item: Item, session: AsyncSession = db_session) -> Item:
+    # Insert the new item unless one with the same name already exists, in one statement
+    statement = (
+        sqlite_insert(Item)
+        .values(**item.model_dump())
+        .on_conflict_do_nothing(index_elements=["name"])
+        .returning(Item)
+    )
+    created_item = (await session.exec(statement)).scalar_one_or_none()
+    if created_item is None:
         raise HTTPException(status_code=400, detail="Item already exists")
-
-    # Add new item
-    session.add(item)
-    session.commit()
-    session.refresh(item)
-    return item
+    # RETURNING already loaded every column, including the generated id
+    await session.commit()
+    return cast(Item, created_item)
 
 
 @router.get("/{item_id}", response_model=Item)
-async def get_item(item_id: int, session: Session = db_session) -> Item:
-    item = session.get(Item, item_id)
+async def get_item(item_id: int, session: AsyncSession = db_session) -> Item:
+    item = await session.get(Item, item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
     return cast(Item, item)
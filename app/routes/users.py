@@ -1,35 +1,40 @@
+import asyncio
 from typing import cast
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
+from fastapi import APIRouter, HTTPException
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.database import get_session
+from app.deps import db_session
 from app.models import User
+from app.security import get_password_hash
 
 router = APIRouter()
 
-# Define dependencies at module level
-db_session = Depends(get_session)
-
 
 @router.post("/", response_model=User)
-async def create_user(user: User, session: Session = db_session) -> User:
-    # Check if user with the same email already exists
-    statement = select(User).where(User.email == user.email)
-    existing_user = session.exec(statement).first()
-    if existing_user:
+async def create_user(user: User, session: AsyncSession = db_session) -> User:
+    # Hash the password off the event loop
+    user.password = await asyncio.to_thread(get_password_hash, user.password)
+
+    # Insert the new user unless one with the same email already exists, in one statement
+    statement = (
+        sqlite_insert(User)
+        .values(**user.model_dump())
+        .on_conflict_do_nothing(index_elements=["email"])
+        .returning(User)
+    )
+    created_user = (await session.exec(statement)).scalar_one_or_none()
+    if created_user is None:
         raise HTTPException(status_code=400, detail="User already exists")
-
-    # Add new user
-    session.add(user)
-    session.commit()
-    session.refresh(user)
-    return user
+    # RETURNING already loaded every column, including the generated id
+    await session.commit()
+    return cast(User, created_user)
 
 
 @router.get("/{user_id}", response_model=User)
-async def get_user(user_id: int, session: Session = db_session) -> User:
-    user = session.get(User, user_id)
+async def get_user(user_id: int, session: AsyncSession = db_session) -> User:
+    user = await session.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return cast(User, user)
@@ -1,24 +1,140 @@
 """Security utilities for password hashing and verification."""
 
-from typing import cast
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
 
+import bcrypt
+from argon2 import PasswordHasher, extract_parameters
+from argon2.exceptions import InvalidHashError, VerificationError
 from dotenv import load_dotenv
-from passlib.context import CryptContext
 
 # Load environment variables
 load_dotenv()
 
-# Password context for hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# argon2id cost parameters for new hashes, tunable to the deployment hardware
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "19456"))
+
+_argon2_hasher = PasswordHasher(
+    time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST, parallelism=1
+)
+
+# bcrypt hashes are still accepted, and only use the first 72 bytes of a password
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+_BCRYPT_MAX_PASSWORD_BYTES = 72
+
+# Shape of a bcrypt hash bcrypt.checkpw accepts: cost 04-31, then 22 salt and 31 hash characters
+_BCRYPT_HASH_PATTERN = re.compile(r"\$2[aby]\$(0[4-9]|[12][0-9]|3[01])\$[./A-Za-z0-9]{53}")
+
+# Cost the legacy bcrypt hashes were created with, set to the BCRYPT_ROUNDS they were hashed at
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# In-process cache of successful verifications, keyed by an HMAC digest so that
+# plaintext passwords are never kept in memory beyond the call. Lookups hash the
+# key with the interpreter's per-process randomised hash before any byte compare,
+# so the timing of a miss reveals nothing usable about stored keys.
+_CACHE_SECRET = secrets.token_bytes(32)
+_CACHE_MAXSIZE = 4096
+_CACHE_TTL_SECONDS = 300
+_verify_cache: OrderedDict[bytes, float] = OrderedDict()
+_verify_cache_lock = threading.Lock()
+
+
+def _cache_key(plain_password: str, hashed_password: str) -> bytes:
+    """Derive a non-reversible cache key for a (hash, password) pair."""
+    message = hashed_password.encode() + b"\0" + plain_password.encode()
+    return hmac.new(_CACHE_SECRET, message, hashlib.sha256).digest()
+
+
+def _verify_cached(key: bytes) -> bool:
+    """Return True if the key belongs to a recent, still-valid successful verify."""
+    with _verify_cache_lock:
+        expires_at = _verify_cache.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            del _verify_cache[key]
+            return False
+        _verify_cache.move_to_end(key)
+        return True
+
+
+def _remember_verified(key: bytes) -> None:
+    """Store a successful verify, evicting the least recently used entry when full."""
+    with _verify_cache_lock:
+        _verify_cache[key] = time.monotonic() + _CACHE_TTL_SECONDS
+        _verify_cache.move_to_end(key)
+        if len(_verify_cache) > _CACHE_MAXSIZE:
+            _verify_cache.popitem(last=False)
+
+
+def is_bcrypt_hash(hashed_password: str) -> bool:
+    """Tell whether a hash is a legacy bcrypt hash."""
+    return hashed_password.startswith(BCRYPT_PREFIXES)
+
+
+def is_known_hash(hashed_password: str) -> bool:
+    """Tell whether a stored value is a well-formed bcrypt or argon2 hash."""
+    if is_bcrypt_hash(hashed_password):
+        return _BCRYPT_HASH_PATTERN.fullmatch(hashed_password) is not None
+    try:
+        extract_parameters(hashed_password)
+    except InvalidHashError:
+        return False
+    return True
+
+
+def _verify_bcrypt(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against a legacy bcrypt hash."""
+    password = plain_password.encode()[:_BCRYPT_MAX_PASSWORD_BYTES]
+    return bcrypt.checkpw(password, hashed_password.encode())
+
+
+def _verify_argon2(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against an argon2 hash."""
+    try:
+        return _argon2_hasher.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a plain password against a hashed password."""
-    result = pwd_context.verify(plain_password, hashed_password)
-    return cast(bool, result)
+    """Verify a plain password against an argon2 or legacy bcrypt hash.
+
+    Only successful verifications are cached, so failed attempts always pay the
+    full hashing cost.
+    """
+    key = _cache_key(plain_password, hashed_password)
+    if _verify_cached(key):
+        return True
+    if is_bcrypt_hash(hashed_password):
+        result = _verify_bcrypt(plain_password, hashed_password)
+    else:
+        result = _verify_argon2(plain_password, hashed_password)
+    if result:
+        _remember_verified(key)
+    return result
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """Tell whether a hash is bcrypt or uses outdated argon2 parameters."""
+    if is_bcrypt_hash(hashed_password):
+        return True
+    return _argon2_hasher.check_needs_rehash(hashed_password)
 
 
 def get_password_hash(password: str) -> str:
-    """Generate a hash for a password."""
-    result = pwd_context.hash(password)
-    return cast(str, result)
+    """Generate an argon2id hash for a password."""
+    return _argon2_hasher.hash(password)
+
+
+def get_bcrypt_hash(password: str) -> str:
+    """Generate a bcrypt hash at the cost of the legacy hashes."""
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password.encode()[:_BCRYPT_MAX_PASSWORD_BYTES], salt).decode()
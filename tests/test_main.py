@@ -1,28 +1,63 @@
-from collections.abc import Generator
+import asyncio
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from datetime import timedelta
 from http import HTTPStatus
+from pathlib import Path
 
+import bcrypt
+import pytest
+from argon2 import PasswordHasher
 from fastapi.testclient import TestClient
+from jose import jwt
+from jose.exceptions import JWTClaimsError
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.pool import StaticPool
-from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.database import get_session
+from app import auth, database, security
+from app.auth import (
+    _DUMMY_BCRYPT_HASH,
+    _DUMMY_HASH,
+    ACCESS_TOKEN_EXPIRE_SECONDS,
+    ALGORITHM,
+    SECRET_KEY,
+    _decode_jwt,
+    create_access_token,
+)
+from app.database import create_tables, get_session, load_test_data
 from app.main import app
+from app.models import User
+from app.routes import background_tasks
+from app.security import get_password_hash, password_needs_rehash, verify_password
 
 # Create a test database in memory
-TEST_DATABASE_URL = "sqlite:///:memory:"
-engine = create_engine(
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+engine = create_async_engine(
     TEST_DATABASE_URL,
     connect_args={"check_same_thread": False},
     poolclass=StaticPool,
 )
 
+
 # Create test database tables
-SQLModel.metadata.create_all(engine)
+async def create_test_tables() -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+
+asyncio.run(create_test_tables())
 
 
 # Override the dependencies with test versions
-def override_get_session() -> Generator[Session, None, None]:
-    with Session(engine) as session:
+async def override_get_session() -> AsyncIterator[AsyncSession]:
+    async with AsyncSession(engine, expire_on_commit=False) as session:
         yield session
 
 
@@ -32,6 +67,9 @@ app.dependency_overrides[get_session] = override_get_session
 # Setup test client with overrides
 client = TestClient(app)
 
+# Allowed ratio between timings of constant-time compares on different inputs
+COMPARE_TIMING_TOLERANCE = 2.0
+
 
 def test_root() -> None:
     response = client.get("/")
@@ -51,7 +89,378 @@ def test_create_user() -> None:
     assert "id" in data
 
 
-def test_background_task() -> None:
+def test_create_item_rejects_duplicate_name() -> None:
+    item = {"name": "Keyboard", "description": "Mechanical keyboard", "price": 89.9, "tax": 8.1}
+    response = client.post("/items/", json=item)
+    assert response.status_code == HTTPStatus.OK
+    item_id = response.json()["id"]
+    assert client.get(f"/items/{item_id}").json()["name"] == "Keyboard"
+
+    response = client.post("/items/", json=item)
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json() == {"detail": "Item already exists"}
+
+
+def test_create_tables_adds_unique_indexes_to_existing_tables(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    legacy_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'legacy.db'}")
+    monkeypatch.setattr(database, "engine", legacy_engine)
+
+    async def upgrade_legacy_database() -> set[str]:
+        # Tables as created before the unique indexes were declared
+        async with legacy_engine.begin() as conn:
+            await conn.execute(
+                text("CREATE TABLE user (id INTEGER PRIMARY KEY, name, email, password)")
+            )
+            await conn.execute(
+                text("CREATE TABLE item (id INTEGER PRIMARY KEY, name, description, price, tax)")
+            )
+        await create_tables()
+        await create_tables()
+        async with legacy_engine.connect() as conn:
+            rows = await conn.execute(
+                text("SELECT name FROM sqlite_master WHERE sql LIKE 'CREATE UNIQUE INDEX%'")
+            )
+            indexes = set(rows.scalars())
+        await legacy_engine.dispose()
+        return indexes
+
+    assert asyncio.run(upgrade_legacy_database()) == {"ix_user_email", "ix_item_name"}
+
+
+def test_access_token_matches_jose_encoding() -> None:
+    token = create_access_token(data={"sub": "john@example.com"})
+    claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    assert claims["sub"] == "john@example.com"
+    assert abs(claims["exp"] - time.time() - ACCESS_TOKEN_EXPIRE_SECONDS) <= 1
+    assert token == jwt.encode(claims, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def test_expired_token_is_rejected() -> None:
+    token = create_access_token(
+        data={"sub": "john@example.com"}, expires_delta=timedelta(seconds=-10)
+    )
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_non_string_subject_is_rejected_like_jose() -> None:
+    token = jwt.encode({"sub": 42, "exp": int(time.time()) + 60}, SECRET_KEY, algorithm=ALGORITHM)
+    with pytest.raises(JWTClaimsError, match="Subject must be a string"):
+        jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    with pytest.raises(JWTClaimsError, match="Subject must be a string"):
+        _decode_jwt(token)
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_login_and_read_current_user() -> None:
+    client.post(
+        "/users/",
+        json={"name": "Login User", "email": "login@example.com", "password": "secret123"},
+    )
+    response = client.post(
+        "/token", data={"username": "login@example.com", "password": "secret123"}
+    )
+    assert response.status_code == HTTPStatus.OK
+    token = response.json()["access_token"]
+
+    # The second request is served from the decoded-token and user-id caches
+    for _ in range(2):
+        response = client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == HTTPStatus.OK
+        assert response.json()["email"] == "login@example.com"
+
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {token}x"})
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+
+    response = client.post(
+        "/token", data={"username": "login@example.com", "password": "wrong-password"}
+    )
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_token_form_marks_password_as_secret() -> None:
+    schema = app.openapi()
+    content = schema["paths"]["/token"]["post"]["requestBody"]["content"]
+    ref = content["application/x-www-form-urlencoded"]["schema"]["$ref"]
+    form_schema = schema["components"]["schemas"][ref.rsplit("/", 1)[-1]]
+    assert form_schema["properties"]["password"]["format"] == "password"
+
+
+def test_unknown_email_never_uses_the_verify_cache() -> None:
+    # The same guessable passwords twice, so a cached dummy verify would show up on the second try
+    for password in ["invalid", "invalid", "password123", "password123"]:
+        response = client.post(
+            "/token", data={"username": "nobody@example.com", "password": password}
+        )
+        assert response.status_code == HTTPStatus.UNAUTHORIZED
+        assert security._cache_key(password, _DUMMY_HASH) not in security._verify_cache
+
+
+@pytest.fixture
+def verified_hashes(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    verified: list[str] = []
+
+    def recording_verify(plain_password: str, hashed_password: str) -> bool:
+        verified.append(hashed_password)
+        return verify_password(plain_password, hashed_password)
+
+    monkeypatch.setattr(auth, "verify_password", recording_verify)
+    monkeypatch.setattr(auth, "_bcrypt_hashes_remain", None)
+    return verified
+
+
+def add_user(email: str, stored_password: str) -> None:
+    async def insert_user() -> None:
+        async with AsyncSession(engine) as session, session.begin():
+            session.add(User(name="Stored User", email=email, password=stored_password))
+
+    asyncio.run(insert_user())
+
+
+def login_verifies(verified: list[str], email: str, password: str) -> list[str]:
+    verified.clear()
+    response = client.post("/token", data={"username": email, "password": password})
+    assert response.status_code in {HTTPStatus.OK, HTTPStatus.UNAUTHORIZED}
+    return list(verified)
+
+
+def test_logins_verify_both_schemes_while_bcrypt_hashes_remain(
+    verified_hashes: list[str],
+) -> None:
+    bcrypt_hash = bcrypt.hashpw(b"legacy123", bcrypt.gensalt(rounds=4)).decode()
+    add_user("legacy@example.com", bcrypt_hash)
+
+    def login(email: str, password: str) -> list[str]:
+        return login_verifies(verified_hashes, email, password)
+
+    # Unknown emails and bcrypt users both pay for one argon2 and one bcrypt verify
+    assert login("nobody@example.com", "legacy123") == [_DUMMY_HASH, _DUMMY_BCRYPT_HASH]
+    assert login("legacy@example.com", "legacy123") == [bcrypt_hash, _DUMMY_HASH]
+
+    # The last bcrypt hash was migrated, so only the argon2 dummy is verified again
+    assert login("nobody@example.com", "legacy123") == [_DUMMY_HASH]
+
+
+def test_unusable_stored_hashes_are_treated_as_missing_users(
+    verified_hashes: list[str],
+) -> None:
+    # Plaintext as stored by the original POST /users, and a bcrypt prefix with an invalid salt
+    add_user("plaintext@example.com", "plain-password")
+    add_user("malformed@example.com", "$2b$12$short")
+    for email, password in [
+        ("plaintext@example.com", "plain-password"),
+        ("malformed@example.com", "plain-password"),
+    ]:
+        unknown_email_verifies = login_verifies(verified_hashes, "nobody@example.com", password)
+        assert login_verifies(verified_hashes, email, password) == unknown_email_verifies
+        response = client.post("/token", data={"username": email, "password": password})
+        assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_seed_and_outdated_hashes_cost_as_much_as_unknown_emails(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, verified_hashes: list[str]
+) -> None:
+    seed_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'seed.db'}")
+    monkeypatch.setattr(database, "engine", seed_engine)
+
+    async def seed_database() -> str:
+        await create_tables()
+        await load_test_data()
+        async with AsyncSession(seed_engine) as session:
+            jane = (await session.exec(select(User).where(User.email == "jane@example.com"))).one()
+        await seed_engine.dispose()
+        return jane.password
+
+    seed_hash = asyncio.run(seed_database())
+    assert not password_needs_rehash(seed_hash)
+    add_user("seed@example.com", seed_hash)
+    outdated_hash = PasswordHasher(time_cost=1, memory_cost=1024).hash("password456")
+    add_user("outdated@example.com", outdated_hash)
+
+    unknown_email_verifies = login_verifies(verified_hashes, "nobody@example.com", "wrong")
+    assert login_verifies(verified_hashes, "seed@example.com", "wrong") == [
+        seed_hash,
+        *unknown_email_verifies[1:],
+    ]
+    # An outdated hash is followed by the full-cost dummy verify an unknown email gets
+    assert login_verifies(verified_hashes, "outdated@example.com", "wrong") == [
+        outdated_hash,
+        *unknown_email_verifies,
+    ]
+
+
+@pytest.fixture
+def audit_log_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    log_path = tmp_path / "audit.log"
+    monkeypatch.setattr(background_tasks, "AUDIT_LOG_PATH", str(log_path))
+    return log_path
+
+
+def test_background_task(audit_log_path: Path) -> None:
     response = client.post("/tasks/action/", params={"user": "testuser"})
     assert response.status_code == HTTPStatus.OK
     assert response.json() == {"message": "Action scheduled"}
+    # No lifespan runs here, so the entry is appended without the batched writer
+    assert audit_log_path.read_text() == "User testuser performed an action\n"
+
+
+def test_audit_log_writer_flushes_on_shutdown(audit_log_path: Path) -> None:
+    async def run_writer(users: list[str]) -> None:
+        writer = background_tasks.start_audit_writer()
+        for user in users:
+            await background_tasks.log_action(user)
+            await asyncio.sleep(0)
+        await background_tasks.stop_audit_writer(writer)
+
+    # Two separate event loops, like two app lifespans, must both be able to write
+    asyncio.run(run_writer(["alice", "bob"]))
+    asyncio.run(run_writer(["carol"]))
+    assert audit_log_path.read_text().splitlines() == [
+        "User alice performed an action",
+        "User bob performed an action",
+        "User carol performed an action",
+    ]
+
+
+def test_audit_log_writes_stay_off_the_event_loop(
+    audit_log_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    writer_threads: list[int] = []
+    real_write = os.write
+
+    def recording_write(fd: int, data: bytes) -> int:
+        writer_threads.append(threading.get_ident())
+        return real_write(fd, data)
+
+    monkeypatch.setattr(background_tasks.os, "write", recording_write)
+
+    async def log_both_ways() -> int:
+        # Once appended directly, once batched through the writer
+        await background_tasks.log_action("alice")
+        writer = background_tasks.start_audit_writer()
+        await background_tasks.log_action("bob")
+        await background_tasks.stop_audit_writer(writer)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(log_both_ways())
+    lines = audit_log_path.read_text().splitlines()
+    assert lines == ["User alice performed an action", "User bob performed an action"]
+    assert len(writer_threads) == len(lines)
+    assert loop_thread not in writer_threads
+
+
+def test_audit_log_writer_failure_is_contained(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(background_tasks, "AUDIT_LOG_PATH", str(tmp_path / "missing" / "a.log"))
+
+    async def run_writer() -> None:
+        writer = background_tasks.start_audit_writer()
+        await asyncio.wait([writer])
+        # Nothing is left queueing into the dead writer, and stopping it doesn't raise
+        assert background_tasks._log_queue is None
+        await background_tasks.stop_audit_writer(writer)
+
+    asyncio.run(run_writer())
+
+
+@pytest.fixture
+def verify_cache(monkeypatch: pytest.MonkeyPatch) -> OrderedDict[bytes, float]:
+    cache: OrderedDict[bytes, float] = OrderedDict()
+    monkeypatch.setattr(security, "_verify_cache", cache)
+    return cache
+
+
+def cheap_bcrypt_hash(password: str) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=4)).decode()
+
+
+def test_successful_verify_is_served_from_the_cache(
+    verify_cache: OrderedDict[bytes, float], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    hashed = cheap_bcrypt_hash("password123")
+    assert verify_password("password123", hashed)
+    assert security._cache_key("password123", hashed) in verify_cache
+
+    def fail_if_called(plain_password: str, hashed_password: str) -> bool:
+        raise AssertionError("cached verify recomputed the hash")
+
+    monkeypatch.setattr(security, "_verify_bcrypt", fail_if_called)
+    assert verify_password("password123", hashed)
+
+
+def test_cached_verify_expires_after_ttl(
+    verify_cache: OrderedDict[bytes, float], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    now = 1000.0
+    monkeypatch.setattr(security.time, "monotonic", lambda: now)
+    hashed = cheap_bcrypt_hash("password123")
+    key = security._cache_key("password123", hashed)
+    assert verify_password("password123", hashed)
+
+    now += security._CACHE_TTL_SECONDS - 1
+    assert security._verify_cached(key)
+    now += 1
+    assert not security._verify_cached(key)
+    assert key not in verify_cache
+
+
+def test_verify_cache_evicts_least_recently_used_entry(
+    verify_cache: OrderedDict[bytes, float], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(security, "_CACHE_MAXSIZE", 2)
+    hashes = {password: cheap_bcrypt_hash(password) for password in ["one", "two", "three"]}
+    keys = {password: security._cache_key(password, hashed) for password, hashed in hashes.items()}
+    assert verify_password("one", hashes["one"])
+    assert verify_password("two", hashes["two"])
+    # Touching "one" makes "two" the least recently used entry
+    assert verify_password("one", hashes["one"])
+    assert verify_password("three", hashes["three"])
+    assert list(verify_cache) == [keys["one"], keys["three"]]
+
+
+def test_failed_verify_is_never_cached(verify_cache: OrderedDict[bytes, float]) -> None:
+    hashed = cheap_bcrypt_hash("password123")
+    for _ in range(2):
+        assert not verify_password("wrong-password", hashed)
+    assert not verify_cache
+
+
+def test_password_hash_roundtrip() -> None:
+    hashed = get_password_hash("password123")
+    assert hashed.startswith("$argon2id$")
+    assert verify_password("password123", hashed)
+    assert not verify_password("wrong-password", hashed)
+    assert not password_needs_rehash(hashed)
+
+
+def test_legacy_bcrypt_hash_is_verified_and_flagged_for_rehash() -> None:
+    hashed = bcrypt.hashpw(b"password123", bcrypt.gensalt(rounds=4)).decode()
+    assert verify_password("password123", hashed)
+    assert not verify_password("wrong-password", hashed)
+    assert password_needs_rehash(hashed)
+    # The bcrypt dummy pads logins at the configured cost of the legacy hashes
+    assert _DUMMY_BCRYPT_HASH.startswith(f"$2b${security.BCRYPT_ROUNDS:02d}$")
+
+
+def test_compare_digest_timing_is_input_independent() -> None:
+    expected = os.urandom(64)
+    matching = bytes(expected)
+    mismatching = bytes([expected[0] ^ 0xFF]) + expected[1:]
+
+    def best_time(candidate: bytes) -> float:
+        timings = []
+        for _ in range(50):
+            start = time.perf_counter()
+            for _ in range(2000):
+                hmac.compare_digest(expected, candidate)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    # An early-exit compare would return much faster on a first-byte mismatch
+    ratio = best_time(matching) / best_time(mismatching)
+    assert 1 / COMPARE_TIMING_TOLERANCE < ratio < COMPARE_TIMING_TOLERANCE